@@ -0,0 +1,441 @@
+"""
+Project Name: PrivateChat
+Description: Benchmarks of chat.py against a local mock of the API
+Author: Juan Terven
+Date: October 2023
+License: MIT
+Contact: jrterven@hotmail.com
+
+Everything runs offline. Run it with:
+    python benchmark.py --output results.json
+
+and compare the JSON files of two releases to spot regressions.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import platform
+import argparse
+import tempfile
+import statistics
+import tracemalloc
+import multiprocessing
+from pathlib import Path
+import tkinter as tk
+
+import chat
+from mock_server import start_server, MockConfig
+
+
+def summary(seconds):
+    """
+    :param seconds: list, Measurements in seconds
+    :return: dict, p50, p95, mean and max in milliseconds
+    """
+    values = sorted(1000 * s for s in seconds)
+    return {"p50": round(values[len(values) // 2], 2),
+            "p95": round(values[min(len(values) - 1, int(len(values) * 0.95))], 2),
+            "mean": round(statistics.fmean(values), 2),
+            "max": round(values[-1], 2)}
+
+
+def setup_chat():
+    """
+    Set the globals that chat.py defines in main.
+    """
+    chat.model = "mock-model"
+    chat.temperature = "0"
+    chat.cache_enabled = False
+    chat.hedge_enabled = False
+    chat.rate_limits = chat.RateLimits()
+    chat.backends = chat.BackendRouter(None)
+    chat.metrics_recorder = None
+
+
+async def bench_turns(url, turns):
+    """
+    Time to first token and latency of whole turns through gpt_analyze_text.
+
+    :param url: str, Base URL of the mock server
+    :param turns: int, Turns of the conversation
+    :return: dict, Results
+    """
+    client_manager = chat.ClientManager()
+    client = client_manager.get("mock-key", url)
+    conversation = chat.Conversation(chat.model, chat.temperature,
+                                     messages=[chat.Message("system", "You are a benchmark.")])
+    messages = conversation.messages
+    ttft = []
+    latency = []
+
+    for i in range(turns):
+        started = time.perf_counter()
+        first_token = []
+
+        def on_token(text):
+            if not first_token:
+                first_token.append(time.perf_counter())
+
+        await chat.gpt_analyze_text(client, messages, f"Question number {i}", conversation,
+                                    on_token=on_token)
+        latency.append(time.perf_counter() - started)
+        ttft.append(first_token[0] - started)
+
+    await client_manager.close()
+    return {"turns": turns, "time_to_first_token_ms": summary(ttft),
+            "turn_latency_ms": summary(latency)}
+
+
+def bench_ui_stall(url, turns):
+    """
+    Longest time the Tk main loop is blocked while streamed responses are shown.
+
+    :param url: str, Base URL of the mock server
+    :param turns: int, Responses to stream
+    :return: dict, Results, or the reason the benchmark was skipped
+    """
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        return {"skipped": f"no display: {e}"}
+
+    text = tk.Text(root)
+    scrollbar = tk.Scrollbar(root, command=text.yview)
+    chat.root = root
+    chat.engine = chat.RequestEngine()
+    chat.render_worker = chat.RenderWorker()
+    conversation = chat.Conversation(chat.model, chat.temperature,
+                                     messages=[chat.Message("system", "You are a benchmark.")])
+    conversation.view = chat.ConversationView(text, scrollbar)
+    conversation.view.clear(conversation.messages)
+    client = chat.ClientManager().get("mock-key", url)
+
+    for request_id in range(turns):
+        prompt = f"Question number {request_id}"
+        conversation.view.begin_request(request_id, prompt)
+        chat.engine.submit(conversation, lambda request_id=request_id, prompt=prompt:
+                           chat.send_prompt_task(client, conversation, prompt, request_id))
+
+    gaps = []
+    last_tick = [time.perf_counter()]
+
+    def tick():
+        now = time.perf_counter()
+        gaps.append(now - last_tick[0])
+        last_tick[0] = now
+        if chat.engine.pending or not chat.ui_queue.empty():
+            root.after(1, tick)
+        else:
+            root.quit()
+
+    root.after(chat.UI_POLL_MS, chat.process_ui_queue)
+    root.after(1, tick)
+    root.mainloop()
+    root.destroy()
+    return {"turns": turns, "main_loop_gap_ms": summary(gaps)}
+
+
+def write_transcript(path, size_bytes):
+    """
+    Write a synthetic exported transcript of about `size_bytes` bytes.
+    """
+    turn = ("User: How do I reverse a list in Python?\n\n"
+            "Assistant: Use slicing:\n    items[::-1]\nor reverse it in place with "
+            "items.reverse(). " + "More details follow. " * 20 + "\n\n")
+    block = turn * max(1, 65536 // len(turn))
+    with path.open("w", encoding="utf-8") as f:
+        written = 0
+        while written < size_bytes:
+            f.write(block)
+            written += len(block)
+
+
+def bench_transcripts(sizes_mb, workdir):
+    """
+    Throughput of parse_conversation, the streaming importer and the streaming
+    exporters.
+
+    :param sizes_mb: list, Transcript sizes in MB
+    :param workdir: Path, Folder for the temporary files
+    :return: dict, MB/s of every step for every size
+    """
+    results = {}
+    for size_mb in sizes_mb:
+        path = workdir / f"transcript_{size_mb}mb.txt"
+        write_transcript(path, size_mb * 1024 * 1024)
+        megabytes = path.stat().st_size / (1024 * 1024)
+
+        started = time.perf_counter()
+        messages = chat.parse_conversation(path.read_text(encoding="utf-8"), [])
+        parse_seconds = time.perf_counter() - started
+
+        started = time.perf_counter()
+        count = sum(1 for _ in chat.iter_conversation(chat.iter_file_lines(path)))
+        stream_seconds = time.perf_counter() - started
+
+        results[f"{size_mb}MB"] = {
+            "messages": count,
+            "parse_conversation_mb_s": round(megabytes / parse_seconds, 1),
+            "streaming_import_mb_s": round(megabytes / stream_seconds, 1),
+        }
+
+        conversation = chat.Conversation("mock-model", "0", messages=messages)
+        for name in ("export.txt", "export.md", "export.jsonl", "export.md.gz"):
+            export_path = workdir / name
+            started = time.perf_counter()
+            chat.export_conversation(conversation, export_path)
+            export_seconds = time.perf_counter() - started
+            results[f"{size_mb}MB"][f"export_{name[7:].replace('.', '_')}_mb_s"] = \
+                round(megabytes / export_seconds, 1)
+            export_path.unlink()
+        del messages, conversation
+        path.unlink()
+    return results
+
+
+def bench_filenames(workdir, files=10000):
+    """
+    Time to allocate the next export name in a folder full of earlier exports.
+
+    :param workdir: Path, Folder for the temporary files
+    :param files: int, Optional; exports already in the folder
+    :return: dict, Milliseconds of one allocation
+    """
+    folder = workdir / "exports"
+    folder.mkdir()
+    for number in range(files):
+        (folder / f"chat{number}.txt").touch()
+    started = time.perf_counter()
+    path = chat.get_output_filename(folder / "chat", "", create=True)
+    allocate_ms = (time.perf_counter() - started) * 1000
+    assert path.name == f"chat{files}.txt"
+    for child in folder.iterdir():
+        child.unlink()
+    folder.rmdir()
+    return {"files": files, "allocate_ms": round(allocate_ms, 2)}
+
+
+def rss_bytes():
+    """
+    :return: int, Resident set size of this process in bytes, or None if unknown
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def measure_history(turns):
+    """
+    Build a conversation of `turns` turns as the application holds it: the message
+    history with its token counts and retrieval index. Runs in a fresh process, so
+    the RSS is not inflated by earlier benchmarks.
+
+    :param turns: int, Turns to build
+    :return: dict, Growth of the RSS, and Python allocations of the history and of the
+        retrieval index, in bytes
+    """
+    setup_chat()
+    prompt = "Explain this code to me please. " * 6
+    answer = "The code iterates over the list and sums the values. " * 20
+    chat.get_numpy()
+    chat.count_tokens("warm up")
+
+    rss_before = rss_bytes()
+    tracemalloc.start()
+    conversation = chat.Conversation(chat.model, chat.temperature,
+                                     messages=[chat.Message("system", "You are a benchmark.")])
+    for i in range(turns):
+        conversation.messages.append(chat.Message("user", f"{i} {prompt}"))
+        conversation.messages.append(chat.Message("assistant", f"{i} {answer}"))
+    conversation.context.token_counts(conversation.messages)
+    history_bytes = tracemalloc.get_traced_memory()[0]
+    # only built by the "retrieval" context policy
+    if chat.get_numpy() is not None:
+        conversation.context.retrieval.update(conversation.messages)
+    retrieval_bytes = tracemalloc.get_traced_memory()[0] - history_bytes
+    tracemalloc.stop()
+    rss_after = rss_bytes()
+
+    count = len(conversation.messages)
+    text_bytes = sum(len(m.content) for m in conversation.messages)
+    return {"rss_bytes": None if rss_before is None else rss_after - rss_before,
+            "history_bytes": history_bytes,
+            "text_bytes": text_bytes,
+            "history_overhead_bytes_per_message": round((history_bytes - text_bytes) / count),
+            "retrieval_index_bytes_per_message": round(retrieval_bytes / count)}
+
+
+def bench_memory(sizes=(1000, 10000, 100000)):
+    """
+    Memory held by conversations of 1k, 10k and 100k turns, each built in its own process.
+
+    :param sizes: tuple, Turns of every conversation
+    :return: dict, Results per size
+    """
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(1, maxtasksperchild=1) as pool:
+        return {f"{turns}_turns": pool.apply(measure_history, (turns,)) for turns in sizes}
+
+
+def bench_search(workdir, conversations=2000, turns=10):
+    """
+    Time to index saved conversations, to refresh an unchanged index and to search it.
+
+    :param workdir: Path, Folder for the temporary files
+    :param conversations: int, Conversation logs to index
+    :param turns: int, Turns of every conversation
+    :return: dict, Results
+    """
+    folder = workdir / "conversations"
+    folder.mkdir()
+    for i in range(conversations):
+        log = chat.ConversationLog(folder / f"conversation{i}.jsonl")
+        for j in range(turns):
+            log.append(chat.Message("user", f"Question {j} about python lists, topic{i}"))
+            log.append(chat.Message("assistant", f"Use slicing to reverse item{i} in place"))
+        log.close()
+
+    index = chat.SearchIndex(workdir / "search.sqlite", folder)
+    started = time.perf_counter()
+    index.refresh()
+    index_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    index.refresh()
+    refresh_seconds = time.perf_counter() - started
+
+    queries = [f"topic{i}" for i in range(0, conversations, max(1, conversations // 20))]
+    latencies = []
+    for query in queries + ["slicing reverse", "pyth"]:
+        started = time.perf_counter()
+        index.search(query)
+        latencies.append(time.perf_counter() - started)
+    index.db.close()
+    return {"conversations": conversations,
+            "index_seconds": round(index_seconds, 2),
+            "unchanged_refresh_ms": round(1000 * refresh_seconds, 1),
+            "search_ms": summary(latencies)}
+
+
+def bench_retrieval(turns=10000, queries=20):
+    """
+    Time of the "retrieval" context policy: indexing a long history once, then
+    scoring it for new prompts.
+
+    :param turns: int, Turns of the history
+    :param queries: int, Prompts to score
+    :return: dict, Results, or the reason the benchmark was skipped
+    """
+    if chat.get_numpy() is None:
+        return {"skipped": "NumPy is not installed"}
+
+    topics = "lists dictionaries generators decorators classes threads sockets files".split()
+    messages = [chat.Message("system", "You are a benchmark.")]
+    for i in range(turns):
+        topic = topics[i % len(topics)]
+        messages.append(chat.Message("user", f"Question {i} about python {topic}"))
+        messages.append(chat.Message("assistant", f"Answer {i}: {topic} work like this. " * 10))
+
+    index = chat.RetrievalIndex()
+    started = time.perf_counter()
+    index.update(messages)
+    index_seconds = time.perf_counter() - started
+
+    latencies = []
+    for i in range(queries):
+        prompt = f"Tell me again about {topics[i % len(topics)]}, as in question {i * 97}"
+        started = time.perf_counter()
+        index.scores(prompt, len(messages))
+        latencies.append(time.perf_counter() - started)
+    return {"turns": turns, "index_seconds": round(index_seconds, 2),
+            "scoring_ms": summary(latencies)}
+
+
+def bench_render(lines=2000, chunk_chars=20):
+    """
+    Time the render worker spends on a long Markdown answer with a fenced code block,
+    rendered whole and streamed in small chunks, and the size of the batches of tag
+    runs the main loop applies.
+
+    :param lines: int, Lines of code in the answer
+    :param chunk_chars: int, Characters per streamed chunk
+    :return: dict, Results
+    """
+    code = "\n".join(f"def function_{i}(items):\n    return [x * {i} for x in items if x]  # {i}"
+                     for i in range(lines // 2))
+    answer = f"## Example\n\nHere is **the code**:\n\n```python\n{code}\n```\n\nUse `function_0`.\n"
+
+    started = time.perf_counter()
+    batches = chat.render_markdown(answer)
+    whole_seconds = time.perf_counter() - started
+
+    renderer = chat.MarkdownRenderer()
+    chunk_times = []
+    for i in range(0, len(answer), chunk_chars):
+        started = time.perf_counter()
+        renderer.feed(answer[i:i + chunk_chars])
+        chunk_times.append(time.perf_counter() - started)
+    renderer.finish()
+
+    return {"lines": answer.count("\n"),
+            "highlighted": chat.get_pygments() is not None,
+            "render_whole_ms": round(1000 * whole_seconds, 1),
+            "stream_chunk_ms": summary(chunk_times),
+            "batches": len(batches),
+            "max_runs_per_batch": max(len(runs) // 2 for runs in batches)}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks of chat.py against a mock API")
+    parser.add_argument("--output", help="JSON file for the results, by default stdout only")
+    parser.add_argument("--turns", type=int, default=20, help="turns of the latency benchmarks")
+    parser.add_argument("--sizes-mb", type=int, nargs="+", default=[1, 100],
+                        help="transcript sizes of the import and export benchmarks")
+    parser.add_argument("--latency", type=float, default=0.2, help="mock latency before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=200, help="mock generation speed")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server, url = start_server(config=MockConfig(latency=args.latency,
+                                                 tokens_per_second=args.tokens_per_second))
+    setup_chat()
+
+    results = {}
+    print("Benchmarking turn latency ...", file=sys.stderr)
+    results["turns"] = asyncio.run(bench_turns(url, args.turns))
+    print("Benchmarking UI stalls ...", file=sys.stderr)
+    results["ui"] = bench_ui_stall(url, min(args.turns, 5))
+    print("Benchmarking transcripts ...", file=sys.stderr)
+    with tempfile.TemporaryDirectory() as workdir:
+        results["transcripts"] = bench_transcripts(args.sizes_mb, Path(workdir))
+        results["export_filenames"] = bench_filenames(Path(workdir))
+    print("Benchmarking search ...", file=sys.stderr)
+    with tempfile.TemporaryDirectory() as workdir:
+        results["search"] = bench_search(Path(workdir))
+    print("Benchmarking retrieval ...", file=sys.stderr)
+    results["retrieval"] = bench_retrieval()
+    print("Benchmarking rendering ...", file=sys.stderr)
+    results["render"] = bench_render()
+    print("Benchmarking memory ...", file=sys.stderr)
+    results["memory"] = bench_memory()
+    server.shutdown()
+
+    report = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "config": vars(args),
+              "results": results}
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
@@ -0,0 +1,223 @@
+"""
+Project Name: PrivateChat
+Description: Local mock of the OpenAI chat completions API for benchmarks and tests
+Author: Juan Terven
+Date: October 2023
+License: MIT
+Contact: jrterven@hotmail.com
+
+Run it with:
+    python mock_server.py --port 8000 --latency 0.5 --tokens-per-second 50
+
+and point the application to it with --base-url http://127.0.0.1:8000/v1
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+         "incididunt ut labore et dolore magna aliqua").split()
+
+
+class MockConfig:
+    """
+    Behaviour of the mock server. The attributes can be changed while it runs.
+
+    :param latency: float, Seconds before the first token, and before the model list
+    :param tokens_per_second: float, Generation speed, 0 for no delay between tokens
+    :param response_tokens: int, Tokens of every response
+    :param error_rate: float, Fraction of the requests answered with `error_status`
+    :param error_status: int, HTTP status of the injected errors, e.g. 429 or 500
+    :param retry_after: float, Value of the retry-after header of the injected errors
+    :param rpm: int, Optional; requests per minute accepted, the rest get a 429. Every
+        response then carries the x-ratelimit headers of the API
+    :param down: bool, Drop every request without an answer, like a crashed backend
+    """
+
+    def __init__(self, latency=0.2, tokens_per_second=100, response_tokens=200,
+                 error_rate=0.0, error_status=429, retry_after=1.0, rpm=None, down=False):
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.response_tokens = response_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.rpm = rpm
+        self.down = down
+        self.requests = 0
+        self.rejected = 0
+        self.accepted = []      # times of the requests accepted in the last minute
+        self.lock = threading.Lock()
+
+    def admit(self):
+        """
+        Count a request against the rpm limit.
+
+        :return: tuple, Whether it is accepted, its x-ratelimit headers and the seconds
+            until the oldest request of the window expires
+        """
+        if self.rpm is None:
+            return True, [], 0
+        with self.lock:
+            now = time.monotonic()
+            self.accepted = [t for t in self.accepted if now - t < 60]
+            accepted = len(self.accepted) < self.rpm
+            if accepted:
+                self.accepted.append(now)
+            else:
+                self.rejected += 1
+            reset = 60 - (now - self.accepted[0]) if self.accepted else 0
+            headers = [("x-ratelimit-limit-requests", str(self.rpm)),
+                       ("x-ratelimit-remaining-requests", str(self.rpm - len(self.accepted))),
+                       ("x-ratelimit-reset-requests", f"{reset:.3f}s")]
+            return accepted, headers, reset
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def send_json(self, status, data, headers=()):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def drop(self):
+        """
+        Close the connection without an answer if the server is down.
+
+        :return: bool, True if the request was dropped
+        """
+        if self.config.down:
+            self.close_connection = True
+        return self.config.down
+
+    def do_GET(self):
+        if self.drop():
+            return
+        time.sleep(self.config.latency)
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json(200, {"object": "list",
+                                 "data": [{"id": "mock-model", "object": "model",
+                                           "created": 0, "owned_by": "mock"}]})
+        else:
+            self.send_json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if self.drop():
+            return
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": "not found"}})
+            return
+
+        config = self.config
+        config.requests += 1
+        accepted, rate_headers, reset = config.admit()
+        if not accepted:
+            self.send_json(429, {"error": {"message": "rate limit reached", "type": "requests"}},
+                           headers=rate_headers + [("retry-after", f"{reset:.3f}")])
+            return
+        if random.random() < config.error_rate:
+            self.send_json(config.error_status,
+                           {"error": {"message": "injected error", "type": "mock_error"}},
+                           headers=[("retry-after", str(config.retry_after))])
+            return
+
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in body.get("messages", []))
+        words = [WORDS[i % len(WORDS)] for i in range(config.response_tokens)]
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                 "total_tokens": prompt_tokens + len(words)}
+        model = body.get("model", "mock-model")
+
+        time.sleep(config.latency)
+        if not body.get("stream"):
+            if config.tokens_per_second:
+                time.sleep(len(words) / config.tokens_per_second)
+            self.send_json(200, {"id": "chatcmpl-mock", "object": "chat.completion",
+                                 "created": int(time.time()), "model": model,
+                                 "choices": [{"index": 0, "finish_reason": "stop",
+                                              "message": {"role": "assistant",
+                                                          "content": " ".join(words)}}],
+                                 "usage": usage}, headers=rate_headers)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for name, value in rate_headers:
+            self.send_header(name, value)
+        self.end_headers()
+
+        def send_chunk(choices, usage=None):
+            data = {"id": "chatcmpl-mock", "object": "chat.completion.chunk",
+                    "created": int(time.time()), "model": model, "choices": choices}
+            if usage is not None:
+                data["usage"] = usage
+            self.send_event(json.dumps(data))
+
+        for i, word in enumerate(words):
+            send_chunk([{"index": 0, "finish_reason": None,
+                         "delta": {"content": word if i == 0 else f" {word}"}}])
+            if config.tokens_per_second:
+                time.sleep(1 / config.tokens_per_second)
+        send_chunk([{"index": 0, "finish_reason": "stop", "delta": {}}])
+        if body.get("stream_options", {}).get("include_usage"):
+            send_chunk([], usage)
+        self.send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def send_event(self, data):
+        event = f"data: {data}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(event):x}\r\n".encode("ascii") + event + b"\r\n")
+        self.wfile.flush()
+
+
+def start_server(port=0, config=None):
+    """
+    Start the mock server in a background thread.
+
+    :param port: int, Optional; port to listen on, 0 picks a free one
+    :param config: MockConfig, Optional; behaviour of the server
+    :return: tuple, The server and its base URL
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    server.daemon_threads = True
+    server.config = config or MockConfig()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock OpenAI-compatible chat completions server")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=100)
+    parser.add_argument("--response-tokens", type=int, default=200)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=429)
+    parser.add_argument("--rpm", type=int, help="requests per minute accepted, the rest get a 429")
+    args = parser.parse_args()
+
+    server, url = start_server(args.port, MockConfig(args.latency, args.tokens_per_second,
+                                                     args.response_tokens, args.error_rate,
+                                                     args.error_status, rpm=args.rpm))
+    print(f"Mock server listening on {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
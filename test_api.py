@@ -0,0 +1,270 @@
+"""
+Project Name: PrivateChat
+Description: Checks of the API layer of chat.py against local mock servers
+Author: Juan Terven
+Date: October 2023
+License: MIT
+Contact: jrterven@hotmail.com
+
+Each check runs against mock_server.py, with no network access. Run them with:
+    python -m pytest -q test_api.py
+or without pytest:
+    python test_api.py
+"""
+import json
+import queue
+import time
+import asyncio
+import argparse
+import tempfile
+from pathlib import Path
+
+import chat
+from mock_server import MockConfig, start_server
+
+
+def setup_chat(workdir, backends_file=None, rpm=None, tpm=None):
+    """
+    Set the globals that chat.py defines in main.
+
+    :param workdir: Path, Folder for the metrics file
+    :param backends_file: Path, Optional; backends of the models, see BackendRouter
+    :param rpm: float, Optional; requests per minute cap, as --rpm
+    :param tpm: float, Optional; tokens per minute cap, as --tpm
+    """
+    chat.model = "mock-model"
+    chat.temperature = "0"
+    chat.cache_enabled = False
+    chat.hedge_enabled = False
+    chat.default_system_msg = "You are a test."
+    chat.client_manager = chat.ClientManager()
+    chat.rate_limits = chat.RateLimits(rpm, tpm)
+    chat.backends = chat.BackendRouter(backends_file)
+    chat.metrics_recorder = chat.MetricsRecorder(workdir / "requests.jsonl")
+
+
+def batch_args(workdir, url, **options):
+    """
+    :return: Namespace, Arguments of the batch command for the mock server at `url`
+    """
+    args = dict(input=str(workdir / "in.jsonl"), output=str(workdir / "out.jsonl"),
+                model="mock-model", temperature="0", concurrency=4, rpm=None, tpm=None,
+                base_url=url, api_key="mock")
+    args.update(options)
+    return argparse.Namespace(**args)
+
+
+class Value:
+    """
+    Stands in for a StringVar of the GUI.
+    """
+
+    def __init__(self):
+        self.value = ""
+
+    def set(self, value):
+        self.value = value
+
+
+def write_prompts(path, count):
+    with path.open("w", encoding="utf-8") as f:
+        for number in range(count):
+            f.write(json.dumps({"id": number, "prompt": f"prompt {number}"}) + "\n")
+
+
+def test_failover_to_second_backend():
+    fast, fast_url = start_server(config=MockConfig(latency=0, tokens_per_second=0,
+                                                    response_tokens=5))
+    slow, slow_url = start_server(config=MockConfig(latency=0.2, tokens_per_second=0,
+                                                    response_tokens=5))
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        backends_file = workdir / "backends.json"
+        backends_file.write_text(json.dumps({"mock-model": [
+            {"base_url": fast_url, "api_key": "mock"},
+            {"base_url": slow_url, "api_key": "mock"}]}))
+        setup_chat(workdir, backends_file)
+        fast_backend, slow_backend = chat.backends.get("mock-model")
+
+        async def ask():
+            client = chat.client_manager.get("mock")
+            metrics = chat.RequestMetrics("mock-model")
+            response = await chat.stream_completion(client, "mock-model",
+                                                    [chat.Message("user", "hi")], "0", [],
+                                                    metrics, stream=True)
+            return response, metrics
+
+        async def run():
+            client = chat.client_manager.get("mock")
+            await asyncio.gather(*(chat.backends.probe(backend, client)
+                                   for backend in (fast_backend, slow_backend)))
+            # the fastest backend is used while it is healthy
+            _, metrics = await ask()
+            assert metrics.backend == fast_backend.name
+
+            # it goes down mid-session: the same call fails over without a backoff
+            fast.config.down = True
+            started = time.perf_counter()
+            response, metrics = await ask()
+            assert response
+            assert metrics.backend == slow_backend.name
+            assert time.perf_counter() - started < chat.API_BACKOFF_BASE + 1
+            assert not fast_backend.healthy
+
+            # unhealthy backends are skipped until a probe brings them back
+            _, metrics = await ask()
+            assert metrics.backend == slow_backend.name
+            fast.config.down = False
+            await chat.backends.probe(fast_backend, client)
+            assert fast_backend.healthy
+            _, metrics = await ask()
+            assert metrics.backend == fast_backend.name
+            await chat.client_manager.close()
+
+        asyncio.run(run())
+    fast.shutdown()
+    slow.shutdown()
+
+
+def test_batch_resume_skips_completed_ids():
+    server, url = start_server(config=MockConfig(latency=0, tokens_per_second=0,
+                                                 response_tokens=5))
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        setup_chat(workdir)
+        write_prompts(workdir / "in.jsonl", 10)
+        # an earlier run answered 0-3, failed 4 and was cut in the middle of a line
+        with (workdir / "out.jsonl").open("w", encoding="utf-8") as f:
+            for number in range(4):
+                f.write(json.dumps({"id": number, "response": "done"}) + "\n")
+            f.write(json.dumps({"id": 4, "error": "APIConnectionError"}) + "\n")
+            f.write('{"id": 5, "respo')
+
+        assert asyncio.run(chat.run_batch(batch_args(workdir, url))) == 0
+        assert server.config.requests == 6
+
+        answered = {}
+        for line in (workdir / "out.jsonl").read_text(encoding="utf-8").splitlines():
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if "error" not in result:
+                answered[result["id"]] = answered.get(result["id"], 0) + 1
+        assert answered == {number: 1 for number in range(10)}
+    server.shutdown()
+
+
+def test_batch_skips_lines_that_are_not_json_objects():
+    server, url = start_server(config=MockConfig(latency=0, tokens_per_second=0,
+                                                 response_tokens=5))
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        setup_chat(workdir)
+        (workdir / "in.jsonl").write_text('{"id": 10, "prompt": "one"}\n'
+                                          'not json\n'
+                                          '[1, 2]\n'
+                                          '{"id": 13, "prompt": "three"}\n', encoding="utf-8")
+
+        assert asyncio.run(chat.run_batch(batch_args(workdir, url))) == 1
+        results = [json.loads(line) for line in
+                   (workdir / "out.jsonl").read_text(encoding="utf-8").splitlines()]
+        assert sorted(result["id"] for result in results if "error" not in result) == [10, 13]
+        assert sorted(result["id"] for result in results if "error" in result) == [1, 2]
+    server.shutdown()
+
+
+def test_batch_rpm_cap_is_enforced():
+    # the server allows far more than --rpm and says so in its headers
+    server, url = start_server(config=MockConfig(latency=0, tokens_per_second=0,
+                                                 response_tokens=5, rpm=10000))
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        setup_chat(workdir, rpm=60)
+        write_prompts(workdir / "in.jsonl", 62)
+
+        started = time.perf_counter()
+        assert asyncio.run(chat.run_batch(batch_args(workdir, url, rpm=60))) == 0
+        # the first 60 requests fill the bucket, the other two wait a second each
+        assert time.perf_counter() - started >= 1.5
+        assert chat.rate_limits.get("mock-model").rpm == 60
+    server.shutdown()
+
+
+def test_rate_limiter_learns_limits_without_debt():
+    async def run():
+        limiter = chat.RateLimiter()
+        # limits unknown: nothing is charged
+        await limiter.acquire(5000)
+        await limiter.release()
+        limiter.update_from_headers({"x-ratelimit-limit-tokens": "10000",
+                                     "x-ratelimit-remaining-tokens": "9900",
+                                     "x-ratelimit-limit-requests": "100",
+                                     "x-ratelimit-remaining-requests": "99"})
+        assert limiter.tokens == 9900
+        assert limiter.requests == 99
+        started = time.perf_counter()
+        await limiter.acquire(5000)
+        await limiter.release()
+        assert time.perf_counter() - started < 0.5
+
+        # explicit limits stay caps over the ones in the headers
+        capped = chat.RateLimiter(rpm=6, tpm=1000)
+        capped.update_from_headers({"x-ratelimit-limit-requests": "10000",
+                                    "x-ratelimit-limit-tokens": "1000000"})
+        assert (capped.rpm, capped.tpm) == (6, 1000)
+
+    asyncio.run(run())
+
+
+def test_compare_records_the_summary_requests():
+    server, url = start_server(config=MockConfig(latency=0, tokens_per_second=0,
+                                                 response_tokens=5))
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        setup_chat(workdir)
+        chat.ui_queue = queue.Queue()
+        chat.CONTEXT_POLICIES["mock-model"] = {"policy": "summarize", "max_tokens": 2000}
+        messages = [chat.Message("system", "You are a test.")]
+        for number in range(20):
+            messages.append(chat.Message("user" if number % 2 == 0 else "assistant",
+                                         f"message {number} " + "word " * 200))
+
+        def purposes():
+            return [record["purpose"] for record in chat.metrics_recorder.records["mock-model"]]
+
+        async def run():
+            client = chat.client_manager.get("mock", url)
+            # the conversation summarizes what it evicts, and records those requests
+            context = chat.ContextManager()
+            await context.build_payload(client, messages + [chat.Message("user", "next")],
+                                        "mock-model")
+            assert context.summary is not None
+            assert purposes() == ["summary"] * len(context.summary_requests)
+
+            # a comparison starts from that summary instead of writing it again
+            footer, total = Value(), Value()
+            await chat.compare_models(client, messages, "next", ["mock-model"], "0", False,
+                                      {"mock-model": (None, footer)}, total,
+                                      (context.summary, context.summarized))
+            assert purposes()[len(context.summary_requests):] == ["compare"]
+
+            # without it, the summary requests of the comparison are recorded too
+            await chat.compare_models(client, messages, "next", ["mock-model"], "0", False,
+                                      {"mock-model": (None, footer)}, total)
+            assert purposes()[-1] == "compare"
+            assert "summary" in purposes()[len(context.summary_requests) + 1:]
+            await chat.client_manager.close()
+
+        try:
+            asyncio.run(run())
+        finally:
+            del chat.CONTEXT_POLICIES["mock-model"]
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    for name, test in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(f"{name}: ok")